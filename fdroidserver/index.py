@@ -21,8 +21,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import concurrent.futures
+import contextlib
 import json
 import logging
+import operator
 import os
 import re
 import shutil
@@ -32,16 +35,91 @@ import zipfile
 import calendar
 from binascii import hexlify, unhexlify
 from datetime import datetime, timezone
-from xml.dom.minidom import Document
+
+try:
+    from lxml import etree
+except ImportError:
+    import xml.etree.ElementTree as etree  # nosec this is only used for writing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from . import _
 from . import common
 from . import metadata
 from . import net
 from . import signindex
-from fdroidserver.common import FDroidPopen, FDroidPopenBytes, load_stats_fdroid_signing_key_fingerprints
+from fdroidserver.common import FDroidPopenBytes, load_stats_fdroid_signing_key_fingerprints
 from fdroidserver.exception import FDroidException, VerificationException
 
+GIT_SSH_URL_REGEX = re.compile(r'^git@(.*):(.*)')
+UNSAFE_LINK_NAME_CHARS_REGEX = re.compile(b'''[ '"&%?+=/]''')
+ANDROID_PERMISSION_PREFIX = 'android.permission.'
+ANDROID_PERMISSION_PREFIX_LEN = len(ANDROID_PERMISSION_PREFIX)
+
+# fields that are left out of index-v1.json
+V1_APP_SKIP_KEYS = frozenset(('builds', 'comments', 'metadatapath',
+                              'ArchivePolicy', 'AutoUpdateMode', 'MaintainerNotes',
+                              'Provides', 'Repo', 'RepoType', 'RequiresRoot',
+                              'UpdateCheckData', 'UpdateCheckIgnore', 'UpdateCheckMode',
+                              'UpdateCheckName', 'NoSourceSince', 'VercodeOperation'))
+V1_PACKAGE_SKIP_KEYS = frozenset(('icon', 'icons', 'icons_src', 'name'))
+
+
+@contextlib.contextmanager
+def _replace_on_success(path):
+    """Yield a temporary path that replaces path only if no exception is raised"""
+    tmp_path = path + '.tmp'
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+class _XMLFragmentFile:
+    """Minimal stand-in for lxml.etree.xmlfile when lxml is not installed
+
+    Rather than writing each element to the file as it comes, the
+    serialized fragments are collected in a list and then written out
+    with a single write once the whole document is done.
+    """
+
+    def __init__(self, output_file, encoding='utf-8'):
+        self.output_file = output_file
+        self.encoding = encoding
+        self.parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            with open(self.output_file, 'wb') as fp:
+                fp.write(''.join(self.parts).encode(self.encoding))
+
+    def write_declaration(self):
+        self.parts.append("<?xml version='1.0' encoding='%s'?>\n" % self.encoding)
+
+    @contextlib.contextmanager
+    def element(self, tag):
+        self.parts.append('<%s>' % tag)
+        yield
+        self.parts.append('</%s>' % tag)
+
+    def write(self, content):
+        if isinstance(content, str):
+            # only used for the whitespace between elements
+            if content.strip():
+                raise ValueError('only whitespace can be written as text: %r' % content)
+            self.parts.append(content)
+        else:
+            self.parts.append(etree.tostring(content, encoding='unicode'))
+
 
 def make(apps, apks, repodir, archive):
     """Generate the repo index files.
@@ -57,8 +135,9 @@ def make(apps, apks, repodir, archive):
     """
     from fdroidserver.update import METADATA_VERSION
 
+    config = common.config
     if not common.options.nosign:
-        common.assert_config_keystore(common.config)
+        common.assert_config_keystore(config)
 
     # Historically the index has been sorted by App Name, so we enforce this ordering here
     sortedids = sorted(apps, key=lambda appid: apps[appid].Name.upper())
@@ -70,35 +149,35 @@ def make(apps, apks, repodir, archive):
     repodict['timestamp'] = datetime.utcnow().replace(tzinfo=timezone.utc)
     repodict['version'] = METADATA_VERSION
 
-    if common.config['repo_maxage'] != 0:
-        repodict['maxage'] = common.config['repo_maxage']
+    if config['repo_maxage'] != 0:
+        repodict['maxage'] = config['repo_maxage']
 
     if archive:
-        repodict['name'] = common.config['archive_name']
-        repodict['icon'] = os.path.basename(common.config['archive_icon'])
-        repodict['address'] = common.config['archive_url']
-        repodict['description'] = common.config['archive_description']
-        urlbasepath = os.path.basename(urllib.parse.urlparse(common.config['archive_url']).path)
+        repodict['name'] = config['archive_name']
+        repodict['icon'] = os.path.basename(config['archive_icon'])
+        repodict['address'] = config['archive_url']
+        repodict['description'] = config['archive_description']
+        urlbasepath = os.path.basename(urllib.parse.urlparse(config['archive_url']).path)
     else:
-        repodict['name'] = common.config['repo_name']
-        repodict['icon'] = os.path.basename(common.config['repo_icon'])
-        repodict['address'] = common.config['repo_url']
-        repodict['description'] = common.config['repo_description']
-        urlbasepath = os.path.basename(urllib.parse.urlparse(common.config['repo_url']).path)
+        repodict['name'] = config['repo_name']
+        repodict['icon'] = os.path.basename(config['repo_icon'])
+        repodict['address'] = config['repo_url']
+        repodict['description'] = config['repo_description']
+        urlbasepath = os.path.basename(urllib.parse.urlparse(config['repo_url']).path)
 
     mirrorcheckfailed = False
     mirrors = []
-    for mirror in common.config.get('mirrors', []):
+    for mirror in config.get('mirrors', []):
         base = os.path.basename(urllib.parse.urlparse(mirror).path.rstrip('/'))
-        if common.config.get('nonstandardwebroot') is not True and base != 'fdroid':
+        if config.get('nonstandardwebroot') is not True and base != 'fdroid':
             logging.error(_("mirror '%s' does not end with 'fdroid'!") % mirror)
             mirrorcheckfailed = True
-        # must end with / or urljoin strips a whole path segment
+        # urlbasepath is a single path segment, so plain concatenation is enough
         if mirror.endswith('/'):
-            mirrors.append(urllib.parse.urljoin(mirror, urlbasepath))
+            mirrors.append(mirror + urlbasepath)
         else:
-            mirrors.append(urllib.parse.urljoin(mirror + '/', urlbasepath))
-    for mirror in common.config.get('servergitmirrors', []):
+            mirrors.append(mirror + '/' + urlbasepath)
+    for mirror in config.get('servergitmirrors', []):
         for url in get_mirror_service_urls(mirror):
             mirrors.append(url + '/' + repodir)
     if mirrorcheckfailed:
@@ -110,11 +189,11 @@ def make(apps, apks, repodir, archive):
     for command in ('install', 'uninstall'):
         packageNames = []
         key = command + '_list'
-        if key in common.config:
-            if isinstance(common.config[key], str):
-                packageNames = [common.config[key]]
-            elif all(isinstance(item, str) for item in common.config[key]):
-                packageNames = common.config[key]
+        if key in config:
+            if isinstance(config[key], str):
+                packageNames = [config[key]]
+            elif all(isinstance(item, str) for item in config[key]):
+                packageNames = config[key]
             else:
                 raise TypeError(_('only accepts strings, lists, and tuples'))
         requestsdict[command] = packageNames
@@ -123,8 +202,23 @@ def make(apps, apks, repodir, archive):
 
     make_v0(sortedapps, apks, repodir, repodict, requestsdict,
             fdroid_signing_key_fingerprints)
-    make_v1(sortedapps, apks, repodir, repodict, requestsdict,
-            fdroid_signing_key_fingerprints)
+    if common.options.nosign:
+        make_v1(sortedapps, apks, repodir, repodict, requestsdict,
+                fdroid_signing_key_fingerprints)
+        logging.debug(_('index-v1 must have a signature, use `fdroid signindex` to create it!'))
+    else:
+        # make_v1 includes the AntiFeatures that make_v0 merges into the
+        # apps, so the two run in order, but jarsigner only needs the
+        # finished index.jar and can run while index-v1.json is generated.
+        # index-v1.jar is only signed once that worked, so a failure does
+        # not leave a fresh index-v1.jar next to a broken index.jar.
+        signindex.config = config
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            signing = executor.submit(signindex.sign_jar, os.path.join(repodir, 'index.jar'))
+            make_v1(sortedapps, apks, repodir, repodict, requestsdict,
+                    fdroid_signing_key_fingerprints)
+        signing.result()
+        signindex.sign_index_v1(repodir, 'index-v1.json')
 
 
 def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints):
@@ -150,20 +244,28 @@ def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_
     # establish sort order of the index
     v1_sort_packages(packages, fdroid_signing_key_fingerprints)
 
+    # Nearly every app and every package has the same keys in the same
+    # insertion order, so the sorted, filtered key list only needs to be
+    # worked out once per distinct key layout rather than once per entry.
+    key_orders = {}
+
+    def _key_order(d, skip):
+        keys = (skip, tuple(d))
+        order = key_orders.get(keys)
+        if order is None:
+            order = [k for k in sorted(d) if k not in skip]
+            key_orders[keys] = order
+        return order
+
     appslist = []
     output['apps'] = appslist
     for packageName, appdict in apps.items():
         d = collections.OrderedDict()
         appslist.append(d)
-        for k, v in sorted(appdict.items()):
+        for k in _key_order(appdict, V1_APP_SKIP_KEYS):
+            v = appdict[k]
             if not v:
                 continue
-            if k in ('builds', 'comments', 'metadatapath',
-                     'ArchivePolicy', 'AutoUpdateMode', 'MaintainerNotes',
-                     'Provides', 'Repo', 'RepoType', 'RequiresRoot',
-                     'UpdateCheckData', 'UpdateCheckIgnore', 'UpdateCheckMode',
-                     'UpdateCheckName', 'NoSourceSince', 'VercodeOperation'):
-                continue
 
             # name things after the App class fields in fdroidclient
             if k == 'id':
@@ -215,26 +317,30 @@ def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_
             output_packages[packageName] = packagelist
         d = collections.OrderedDict()
         packagelist.append(d)
-        for k, v in sorted(package.items()):
+        for k in _key_order(package, V1_PACKAGE_SKIP_KEYS):
+            v = package[k]
             if not v:
                 continue
-            if k in ('icon', 'icons', 'icons_src', 'name', ):
-                continue
             d[k] = v
 
     json_name = 'index-v1.json'
     index_file = os.path.join(repodir, json_name)
-    with open(index_file, 'w') as fp:
+    if orjson:
+        # datetimes must go through _index_encoder_default to get Java millis
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
         if common.options.pretty:
-            json.dump(output, fp, default=_index_encoder_default, indent=2)
-        else:
-            json.dump(output, fp, default=_index_encoder_default)
-
-    if common.options.nosign:
-        logging.debug(_('index-v1 must have a signature, use `fdroid signindex` to create it!'))
+            option |= orjson.OPT_INDENT_2
+        with open(index_file, 'wb') as fp:
+            fp.write(orjson.dumps(output, default=_index_encoder_default, option=option))
     else:
-        signindex.config = common.config
-        signindex.sign_index_v1(repodir, json_name)
+        with open(index_file, 'w', encoding='utf-8') as fp:
+            if common.options.pretty:
+                json.dump(output, fp, default=_index_encoder_default,
+                          ensure_ascii=False, indent=2)
+            else:
+                # match orjson's compact output byte for byte
+                json.dump(output, fp, default=_index_encoder_default,
+                          ensure_ascii=False, separators=(',', ':'))
 
 
 def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
@@ -276,27 +382,37 @@ def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
 def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints):
     """
     aka index.jar aka index.xml
-    """
 
-    doc = Document()
+    index.jar is left unsigned, make() signs it.
+    """
 
-    def addElement(name, value, doc, parent):
-        el = doc.createElement(name)
-        el.appendChild(doc.createTextNode(value))
-        parent.appendChild(el)
+    def addElement(name, value, parent):
+        el = etree.SubElement(parent, name)
+        el.text = value
 
-    def addElementNonEmpty(name, value, doc, parent):
+    def addElementNonEmpty(name, value, parent):
         if not value:
             return
-        addElement(name, value, doc, parent)
+        addElement(name, value, parent)
 
-    def addElementIfInApk(name, apk, key, doc, parent):
+    def addElementIfInApk(name, apk, key, parent):
         if key not in apk:
             return
         value = str(apk[key])
-        addElement(name, value, doc, parent)
+        addElement(name, value, parent)
+
+    def writeElement(xf, el):
+        """Write a child of <fdroid>, with --pretty laid out like minidom used to"""
+        if pretty:
+            if hasattr(etree, 'indent'):  # lxml 4.5+ or Python 3.9+
+                etree.indent(el, space='\t', level=1)
+            xf.write('\t')
+            xf.write(el)
+            xf.write('\n')
+        else:
+            xf.write(el)
 
-    def addElementCheckLocalized(name, app, key, doc, parent, default=''):
+    def addElementCheckLocalized(name, app, key, parent, default=''):
         """Fill in field from metadata or localized block
 
         For name/summary/description, they can come only from the app source,
@@ -309,7 +425,6 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
 
         """
 
-        el = doc.createElement(name)
         value = app.get(key)
         lkey = key[:1].lower() + key[1:]
         localized = app.get('localized')
@@ -326,245 +441,251 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
             value = localized[lang].get(lkey)
         if not value:
             value = default
-        el.appendChild(doc.createTextNode(value))
-        parent.appendChild(el)
-
-    root = doc.createElement("fdroid")
-    doc.appendChild(root)
+        addElement(name, value, parent)
 
-    repoel = doc.createElement("repo")
-    repoel.setAttribute("icon", os.path.basename(repodict['icon']))
-    if 'maxage' in repodict:
-        repoel.setAttribute("maxage", str(repodict['maxage']))
-    repoel.setAttribute("name", repodict['name'])
     pubkey, repo_pubkey_fingerprint = extract_pubkey()
-    repoel.setAttribute("pubkey", pubkey.decode('utf-8'))
-    repoel.setAttribute("timestamp", '%d' % repodict['timestamp'].timestamp())
-    repoel.setAttribute("url", repodict['address'])
-    repoel.setAttribute("version", str(repodict['version']))
-
-    addElement('description', repodict['description'], doc, repoel)
-    for mirror in repodict.get('mirrors', []):
-        addElement('mirror', mirror, doc, repoel)
-
-    root.appendChild(repoel)
-
-    for command in ('install', 'uninstall'):
-        for packageName in requestsdict[command]:
-            element = doc.createElement(command)
-            root.appendChild(element)
-            element.setAttribute('packageName', packageName)
-
-    for appid, appdict in apps.items():
-        app = metadata.App(appdict)
-
-        if app.Disabled is not None:
-            continue
 
-        # Get a list of the apks for this app...
-        apklist = []
-        apksbyversion = collections.defaultdict(lambda: [])
-        for apk in apks:
-            if apk.get('versionCode') and apk.get('packageName') == appid:
-                apksbyversion[apk['versionCode']].append(apk)
-        for versionCode, apksforver in apksbyversion.items():
-            fdroidsig = fdroid_signing_key_fingerprints.get(appid, {}).get('signer')
-            fdroid_signed_apk = None
-            name_match_apk = None
-            for x in apksforver:
-                if fdroidsig and x.get('signer', None) == fdroidsig:
-                    fdroid_signed_apk = x
-                if common.apk_release_filename.match(x.get('apkName', '')):
-                    name_match_apk = x
-            # choose which of the available versions is most
-            # suiteable for index v0
-            if fdroid_signed_apk:
-                apklist.append(fdroid_signed_apk)
-            elif name_match_apk:
-                apklist.append(name_match_apk)
-            else:
-                apklist.append(apksforver[0])
-
-        if len(apklist) == 0:
-            continue
+    # group the apks by app once, rather than scanning all of them per app
+    apksbypackage = collections.defaultdict(list)
+    for apk in apks:
+        if apk.get('versionCode'):
+            apksbypackage[apk.get('packageName')].append(apk)
+
+    pretty = common.options.pretty
+    # only create the current version links in the main repo, not the archive
+    make_current_version_link = common.config.get('make_current_version_link') and repodir == 'repo'
+    namefield = common.config.get('current_version_name_source')
+    if make_current_version_link:
+        # read the existing links once, so unchanged ones can be left alone
+        existing_links = {e.name: os.readlink(e.path) for e in list(os.scandir(b'.')) if e.is_symlink()}
+    xmlfile = getattr(etree, 'xmlfile', _XMLFragmentFile)
+    # index.xml is streamed out app by app, so write it to a temporary file
+    # to keep the last good index in place if anything fails part way
+    with _replace_on_success(os.path.join(repodir, 'index.xml')) as index_xml, \
+            xmlfile(index_xml, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('fdroid'):
+            if pretty:
+                xf.write('\n')
+
+            repoel = etree.Element("repo")
+            repoel.set("icon", os.path.basename(repodict['icon']))
+            if 'maxage' in repodict:
+                repoel.set("maxage", str(repodict['maxage']))
+            repoel.set("name", repodict['name'])
+            repoel.set("pubkey", pubkey.decode('utf-8'))
+            repoel.set("timestamp", '%d' % repodict['timestamp'].timestamp())
+            repoel.set("url", repodict['address'])
+            repoel.set("version", str(repodict['version']))
+
+            addElement('description', repodict['description'], repoel)
+            for mirror in repodict.get('mirrors', []):
+                addElement('mirror', mirror, repoel)
+            writeElement(xf, repoel)
+
+            for command in ('install', 'uninstall'):
+                for packageName in requestsdict[command]:
+                    writeElement(xf, etree.Element(command, packageName=packageName))
+
+            for appid, app in apps.items():
+                if app.get('Disabled') is not None:
+                    continue
 
-        apel = doc.createElement("application")
-        apel.setAttribute("id", app.id)
-        root.appendChild(apel)
-
-        addElement('id', app.id, doc, apel)
-        if app.added:
-            addElement('added', app.added.strftime('%Y-%m-%d'), doc, apel)
-        if app.lastUpdated:
-            addElement('lastupdated', app.lastUpdated.strftime('%Y-%m-%d'), doc, apel)
-
-        addElementCheckLocalized('name', app, 'Name', doc, apel)
-        addElementCheckLocalized('summary', app, 'Summary', doc, apel)
-
-        if app.icon:
-            addElement('icon', app.icon, doc, apel)
-
-        addElementCheckLocalized('desc', app, 'Description', doc, apel,
-                                 '<p>No description available</p>')
-
-        addElement('license', app.License, doc, apel)
-        if app.Categories:
-            addElement('categories', ','.join(app.Categories), doc, apel)
-            # We put the first (primary) category in LAST, which will have
-            # the desired effect of making clients that only understand one
-            # category see that one.
-            addElement('category', app.Categories[0], doc, apel)
-        addElement('web', app.WebSite, doc, apel)
-        addElement('source', app.SourceCode, doc, apel)
-        addElement('tracker', app.IssueTracker, doc, apel)
-        addElementNonEmpty('changelog', app.Changelog, doc, apel)
-        addElementNonEmpty('author', app.AuthorName, doc, apel)
-        addElementNonEmpty('email', app.AuthorEmail, doc, apel)
-        addElementNonEmpty('donate', app.Donate, doc, apel)
-        addElementNonEmpty('bitcoin', app.Bitcoin, doc, apel)
-        addElementNonEmpty('litecoin', app.Litecoin, doc, apel)
-        addElementNonEmpty('flattr', app.FlattrID, doc, apel)
-        addElementNonEmpty('liberapay', app.LiberapayID, doc, apel)
-        addElementNonEmpty('openCollective', app.OpenCollective, doc, apel)
-
-        # These elements actually refer to the current version (i.e. which
-        # one is recommended. They are historically mis-named, and need
-        # changing, but stay like this for now to support existing clients.
-        addElement('marketversion', app.CurrentVersion, doc, apel)
-        addElement('marketvercode', app.CurrentVersionCode, doc, apel)
-
-        if app.Provides:
-            pv = app.Provides.split(',')
-            addElementNonEmpty('provides', ','.join(pv), doc, apel)
-        if app.RequiresRoot:
-            addElement('requirements', 'root', doc, apel)
-
-        # Sort the apk list into version order, just so the web site
-        # doesn't have to do any work by default...
-        apklist = sorted(apklist, key=lambda apk: apk['versionCode'], reverse=True)
-
-        if 'antiFeatures' in apklist[0]:
-            app.AntiFeatures.extend(apklist[0]['antiFeatures'])
-        if app.AntiFeatures:
-            addElementNonEmpty('antifeatures', ','.join(app.AntiFeatures), doc, apel)
-
-        # Check for duplicates - they will make the client unhappy...
-        for i in range(len(apklist) - 1):
-            first = apklist[i]
-            second = apklist[i + 1]
-            if first['versionCode'] == second['versionCode'] \
-               and first['sig'] == second['sig']:
-                if first['hash'] == second['hash']:
-                    raise FDroidException('"{0}/{1}" and "{0}/{2}" are exact duplicates!'.format(
-                        repodir, first['apkName'], second['apkName']))
-                else:
-                    raise FDroidException('duplicates: "{0}/{1}" - "{0}/{2}"'.format(
-                        repodir, first['apkName'], second['apkName']))
-
-        current_version_code = 0
-        current_version_file = None
-        for apk in apklist:
-            file_extension = common.get_file_extension(apk['apkName'])
-            # find the APK for the "Current Version"
-            if current_version_code < apk['versionCode']:
-                current_version_code = apk['versionCode']
-            if current_version_code < int(app.CurrentVersionCode):
-                current_version_file = apk['apkName']
-
-            apkel = doc.createElement("package")
-            apel.appendChild(apkel)
-
-            versionName = apk.get('versionName')
-            if not versionName:
-                versionCodeStr = str(apk['versionCode'])  # TODO build.versionCode should be int!
-                for build in app.builds:
-                    if build['versionCode'] == versionCodeStr and 'versionName' in build:
-                        versionName = build['versionName']
-                        break
-            if versionName:
-                addElement('version', versionName, doc, apkel)
-
-            addElement('versioncode', str(apk['versionCode']), doc, apkel)
-            addElement('apkname', apk['apkName'], doc, apkel)
-            addElementIfInApk('srcname', apk, 'srcname', doc, apkel)
-
-            hashel = doc.createElement("hash")
-            hashel.setAttribute('type', 'sha256')
-            hashel.appendChild(doc.createTextNode(apk['hash']))
-            apkel.appendChild(hashel)
-
-            addElement('size', str(apk['size']), doc, apkel)
-            addElementIfInApk('sdkver', apk,
-                              'minSdkVersion', doc, apkel)
-            addElementIfInApk('targetSdkVersion', apk,
-                              'targetSdkVersion', doc, apkel)
-            addElementIfInApk('maxsdkver', apk,
-                              'maxSdkVersion', doc, apkel)
-            addElementIfInApk('obbMainFile', apk,
-                              'obbMainFile', doc, apkel)
-            addElementIfInApk('obbMainFileSha256', apk,
-                              'obbMainFileSha256', doc, apkel)
-            addElementIfInApk('obbPatchFile', apk,
-                              'obbPatchFile', doc, apkel)
-            addElementIfInApk('obbPatchFileSha256', apk,
-                              'obbPatchFileSha256', doc, apkel)
-            if 'added' in apk:
-                addElement('added', apk['added'].strftime('%Y-%m-%d'), doc, apkel)
-
-            if file_extension == 'apk':  # sig is required for APKs, but only APKs
-                addElement('sig', apk['sig'], doc, apkel)
-
-                old_permissions = set()
-                sorted_permissions = sorted(apk['uses-permission'])
-                for perm in sorted_permissions:
-                    perm_name = perm[0]
-                    if perm_name.startswith("android.permission."):
-                        perm_name = perm_name[19:]
-                    old_permissions.add(perm_name)
-                addElementNonEmpty('permissions', ','.join(sorted(old_permissions)), doc, apkel)
-
-                for permission in sorted_permissions:
-                    permel = doc.createElement('uses-permission')
-                    if permission[1] is not None:
-                        permel.setAttribute('maxSdkVersion', '%d' % permission[1])
-                        apkel.appendChild(permel)
-                    permel.setAttribute('name', permission[0])
-                for permission_sdk_23 in sorted(apk['uses-permission-sdk-23']):
-                    permel = doc.createElement('uses-permission-sdk-23')
-                    if permission_sdk_23[1] is not None:
-                        permel.setAttribute('maxSdkVersion', '%d' % permission_sdk_23[1])
-                        apkel.appendChild(permel)
-                    permel.setAttribute('name', permission_sdk_23[0])
-                if 'nativecode' in apk:
-                    addElement('nativecode', ','.join(sorted(apk['nativecode'])), doc, apkel)
-                addElementNonEmpty('features', ','.join(sorted(apk['features'])), doc, apkel)
-
-        if current_version_file is not None \
-                and common.config['make_current_version_link'] \
-                and repodir == 'repo':  # only create these
-            namefield = common.config['current_version_name_source']
-            sanitized_name = re.sub(b'''[ '"&%?+=/]''', b'', app.get(namefield).encode('utf-8'))
-            apklinkname = sanitized_name + os.path.splitext(current_version_file)[1].encode('utf-8')
-            current_version_path = os.path.join(repodir, current_version_file).encode('utf-8', 'surrogateescape')
-            if os.path.islink(apklinkname):
-                os.remove(apklinkname)
-            os.symlink(current_version_path, apklinkname)
-            # also symlink gpg signature, if it exists
-            for extension in (b'.asc', b'.sig'):
-                sigfile_path = current_version_path + extension
-                if os.path.exists(sigfile_path):
-                    siglinkname = apklinkname + extension
-                    if os.path.islink(siglinkname):
-                        os.remove(siglinkname)
-                    os.symlink(sigfile_path, siglinkname)
-
-    if common.options.pretty:
-        output = doc.toprettyxml(encoding='utf-8')
-    else:
-        output = doc.toxml(encoding='utf-8')
+                # Get a list of the apks for this app...
+                apklist = []
+                apksbyversion = collections.defaultdict(lambda: [])
+                for apk in apksbypackage.get(appid, []):
+                    apksbyversion[apk['versionCode']].append(apk)
+                for versionCode, apksforver in apksbyversion.items():
+                    fdroidsig = fdroid_signing_key_fingerprints.get(appid, {}).get('signer')
+                    fdroid_signed_apk = None
+                    name_match_apk = None
+                    for x in apksforver:
+                        if fdroidsig and x.get('signer', None) == fdroidsig:
+                            fdroid_signed_apk = x
+                        if common.apk_release_filename.match(x.get('apkName', '')):
+                            name_match_apk = x
+                    # choose which of the available versions is most
+                    # suiteable for index v0
+                    if fdroid_signed_apk:
+                        apklist.append(fdroid_signed_apk)
+                    elif name_match_apk:
+                        apklist.append(name_match_apk)
+                    else:
+                        apklist.append(apksforver[0])
+
+                if len(apklist) == 0:
+                    continue
 
-    with open(os.path.join(repodir, 'index.xml'), 'wb') as f:
-        f.write(output)
+                apel = etree.Element("application", id=app['id'])
+
+                addElement('id', app['id'], apel)
+                if app['added']:
+                    addElement('added', app['added'].strftime('%Y-%m-%d'), apel)
+                if app['lastUpdated']:
+                    addElement('lastupdated', app['lastUpdated'].strftime('%Y-%m-%d'), apel)
+
+                addElementCheckLocalized('name', app, 'Name', apel)
+                addElementCheckLocalized('summary', app, 'Summary', apel)
+
+                if app.get('icon'):
+                    addElement('icon', app['icon'], apel)
+
+                addElementCheckLocalized('desc', app, 'Description', apel,
+                                         '<p>No description available</p>')
+
+                addElement('license', app['License'], apel)
+                if app['Categories']:
+                    addElement('categories', ','.join(app['Categories']), apel)
+                    # We put the first (primary) category in LAST, which will have
+                    # the desired effect of making clients that only understand one
+                    # category see that one.
+                    addElement('category', app['Categories'][0], apel)
+                addElement('web', app['WebSite'], apel)
+                addElement('source', app['SourceCode'], apel)
+                addElement('tracker', app['IssueTracker'], apel)
+                addElementNonEmpty('changelog', app['Changelog'], apel)
+                addElementNonEmpty('author', app['AuthorName'], apel)
+                addElementNonEmpty('email', app['AuthorEmail'], apel)
+                addElementNonEmpty('donate', app['Donate'], apel)
+                addElementNonEmpty('bitcoin', app['Bitcoin'], apel)
+                addElementNonEmpty('litecoin', app['Litecoin'], apel)
+                addElementNonEmpty('flattr', app['FlattrID'], apel)
+                addElementNonEmpty('liberapay', app['LiberapayID'], apel)
+                addElementNonEmpty('openCollective', app['OpenCollective'], apel)
+
+                # These elements actually refer to the current version (i.e. which
+                # one is recommended. They are historically mis-named, and need
+                # changing, but stay like this for now to support existing clients.
+                addElement('marketversion', app['CurrentVersion'], apel)
+                addElement('marketvercode', app['CurrentVersionCode'], apel)
+
+                if app['Provides']:
+                    pv = app['Provides'].split(',')
+                    addElementNonEmpty('provides', ','.join(pv), apel)
+                if app['RequiresRoot']:
+                    addElement('requirements', 'root', apel)
+
+                # Sort the apk list into version order, just so the web site
+                # doesn't have to do any work by default...
+                apklist.sort(key=operator.itemgetter('versionCode'), reverse=True)
+
+                if 'antiFeatures' in apklist[0]:
+                    app['AntiFeatures'].extend(apklist[0]['antiFeatures'])
+                if app['AntiFeatures']:
+                    addElementNonEmpty('antifeatures', ','.join(app['AntiFeatures']), apel)
+
+                # Check for duplicates - they will make the client unhappy...
+                versionCodes = [apk['versionCode'] for apk in apklist]
+                for i in range(len(apklist) - 1):
+                    if versionCodes[i] != versionCodes[i + 1]:
+                        continue
+                    first = apklist[i]
+                    second = apklist[i + 1]
+                    if first['sig'] == second['sig']:
+                        if first['hash'] == second['hash']:
+                            raise FDroidException('"{0}/{1}" and "{0}/{2}" are exact duplicates!'.format(
+                                repodir, first['apkName'], second['apkName']))
+                        else:
+                            raise FDroidException('duplicates: "{0}/{1}" - "{0}/{2}"'.format(
+                                repodir, first['apkName'], second['apkName']))
+
+                current_version_code = 0
+                current_version_file = None
+                suggested_version_code = int(app['CurrentVersionCode'])
+                for apk, versionCode in zip(apklist, versionCodes):
+                    apkName = apk['apkName']
+                    file_extension = common.get_file_extension(apkName)
+                    # find the APK for the "Current Version"
+                    if current_version_code < versionCode:
+                        current_version_code = versionCode
+                    if current_version_code < suggested_version_code:
+                        current_version_file = apkName
+
+                    apkel = etree.SubElement(apel, "package")
+
+                    versionName = apk.get('versionName')
+                    if not versionName:
+                        versionCodeStr = str(versionCode)  # TODO build.versionCode should be int!
+                        for build in app['builds']:
+                            if build['versionCode'] == versionCodeStr and 'versionName' in build:
+                                versionName = build['versionName']
+                                break
+                    if versionName:
+                        addElement('version', versionName, apkel)
+
+                    addElement('versioncode', str(versionCode), apkel)
+                    addElement('apkname', apkName, apkel)
+                    addElementIfInApk('srcname', apk, 'srcname', apkel)
+
+                    hashel = etree.SubElement(apkel, "hash", type='sha256')
+                    hashel.text = apk['hash']
+
+                    addElement('size', str(apk['size']), apkel)
+                    addElementIfInApk('sdkver', apk,
+                                      'minSdkVersion', apkel)
+                    addElementIfInApk('targetSdkVersion', apk,
+                                      'targetSdkVersion', apkel)
+                    addElementIfInApk('maxsdkver', apk,
+                                      'maxSdkVersion', apkel)
+                    addElementIfInApk('obbMainFile', apk,
+                                      'obbMainFile', apkel)
+                    addElementIfInApk('obbMainFileSha256', apk,
+                                      'obbMainFileSha256', apkel)
+                    addElementIfInApk('obbPatchFile', apk,
+                                      'obbPatchFile', apkel)
+                    addElementIfInApk('obbPatchFileSha256', apk,
+                                      'obbPatchFileSha256', apkel)
+                    if 'added' in apk:
+                        addElement('added', apk['added'].strftime('%Y-%m-%d'), apkel)
+
+                    if file_extension == 'apk':  # sig is required for APKs, but only APKs
+                        addElement('sig', apk['sig'], apkel)
+
+                        sorted_permissions = sorted(apk['uses-permission'])
+                        old_permissions = {
+                            perm[0][ANDROID_PERMISSION_PREFIX_LEN:]
+                            if perm[0].startswith(ANDROID_PERMISSION_PREFIX) else perm[0]
+                            for perm in sorted_permissions
+                        }
+                        addElementNonEmpty('permissions', ','.join(sorted(old_permissions)), apkel)
+
+                        for permission in sorted_permissions:
+                            if permission[1] is not None:
+                                permel = etree.SubElement(apkel, 'uses-permission')
+                                permel.set('maxSdkVersion', '%d' % permission[1])
+                                permel.set('name', permission[0])
+                        for permission_sdk_23 in sorted(apk['uses-permission-sdk-23']):
+                            if permission_sdk_23[1] is not None:
+                                permel = etree.SubElement(apkel, 'uses-permission-sdk-23')
+                                permel.set('maxSdkVersion', '%d' % permission_sdk_23[1])
+                                permel.set('name', permission_sdk_23[0])
+                        if 'nativecode' in apk:
+                            addElement('nativecode', ','.join(sorted(apk['nativecode'])), apkel)
+                        addElementNonEmpty('features', ','.join(sorted(apk['features'])), apkel)
+
+                writeElement(xf, apel)
+
+                if current_version_file is not None and make_current_version_link:
+                    sanitized_name = UNSAFE_LINK_NAME_CHARS_REGEX.sub(b'', app.get(namefield).encode('utf-8'))
+                    apklinkname = sanitized_name + os.path.splitext(current_version_file)[1].encode('utf-8')
+                    current_version_path = os.path.join(repodir, current_version_file).encode('utf-8', 'surrogateescape')
+                    if existing_links.get(apklinkname) != current_version_path:
+                        if apklinkname in existing_links:
+                            os.remove(apklinkname)
+                        os.symlink(current_version_path, apklinkname)
+                        existing_links[apklinkname] = current_version_path
+                    # also symlink gpg signature, if it exists
+                    for extension in (b'.asc', b'.sig'):
+                        sigfile_path = current_version_path + extension
+                        siglinkname = apklinkname + extension
+                        if existing_links.get(siglinkname) == sigfile_path:
+                            continue
+                        if os.path.exists(sigfile_path):
+                            if siglinkname in existing_links:
+                                os.remove(siglinkname)
+                            os.symlink(sigfile_path, siglinkname)
+                            existing_links[siglinkname] = sigfile_path
 
     if 'repo_keyalias' in common.config:
 
@@ -576,24 +697,27 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
 
         # Create a jar of the index...
         jar_output = 'index_unsigned.jar' if common.options.nosign else 'index.jar'
-        p = FDroidPopen(['jar', 'cf', jar_output, 'index.xml'], cwd=repodir)
-        if p.returncode != 0:
-            raise FDroidException("Failed to create {0}".format(jar_output))
+        with zipfile.ZipFile(os.path.join(repodir, jar_output), 'w', zipfile.ZIP_DEFLATED) as jar:
+            jar.write(os.path.join(repodir, 'index.xml'), 'index.xml')
 
-        # Sign the index...
-        signed = os.path.join(repodir, 'index.jar')
         if common.options.nosign:
             # Remove old signed index if not signing
+            signed = os.path.join(repodir, 'index.jar')
             if os.path.exists(signed):
                 os.remove(signed)
-        else:
-            signindex.config = common.config
-            signindex.sign_jar(signed)
 
     # Copy the repo icon into the repo directory...
     icon_dir = os.path.join(repodir, 'icons')
     iconfilename = os.path.join(icon_dir, os.path.basename(common.config['repo_icon']))
-    shutil.copyfile(common.config['repo_icon'], iconfilename)
+    in_stat = os.stat(common.config['repo_icon'])
+    if os.path.exists(iconfilename):
+        out_stat = os.stat(iconfilename)
+        unchanged = in_stat.st_size == out_stat.st_size \
+            and in_stat.st_mtime == out_stat.st_mtime
+    else:
+        unchanged = False
+    if not unchanged:
+        shutil.copy2(common.config['repo_icon'], iconfilename)
 
 
 def extract_pubkey():
@@ -634,7 +758,7 @@ def get_mirror_service_urls(url):
     '''
 
     if url.startswith('git@'):
-        url = re.sub(r'^git@(.*):(.*)', r'https://\1/\2', url)
+        url = GIT_SSH_URL_REGEX.sub(r'https://\1/\2', url)
 
     segments = url.split("/")
 
@@ -722,7 +846,10 @@ def get_index_from_jar(jarfile, fingerprint=None):
         if fingerprint is not None:
             if fingerprint.upper() != public_key_fingerprint:
                 raise VerificationException(_("The repository's fingerprint does not match."))
-        data = json.loads(jar.read('index-v1.json').decode())
+        if orjson:
+            data = orjson.loads(jar.read('index-v1.json'))
+        else:
+            data = json.loads(jar.read('index-v1.json').decode())
         return data, public_key, public_key_fingerprint
 
 
@@ -736,14 +863,15 @@ def get_public_key_from_jar(jar):
     :return: the public key from the jar and its fingerprint
     """
     # extract certificate from jar
-    certs = [n for n in jar.namelist() if common.SIGNATURE_BLOCK_FILE_REGEX.match(n)]
-    if len(certs) < 1:
+    certs = (n for n in jar.namelist() if common.SIGNATURE_BLOCK_FILE_REGEX.match(n))
+    cert = next(certs, None)
+    if cert is None:
         raise VerificationException(_("Found no signing certificates for repository."))
-    if len(certs) > 1:
+    if next(certs, None) is not None:
         raise VerificationException(_("Found multiple signing certificates for repository."))
 
     # extract public key from certificate
-    public_key = common.get_certificate(jar.read(certs[0]))
+    public_key = common.get_certificate(jar.read(cert))
     public_key_fingerprint = common.get_cert_fingerprint(public_key).replace(' ', '')
 
     return public_key, public_key_fingerprint
@@ -32,7 +32,6 @@ import hashlib
 import json
 import time
 import yaml
-import copy
 from datetime import datetime
 from argparse import ArgumentParser
 from base64 import urlsafe_b64encode
@@ -2206,24 +2205,25 @@ def render_app_descriptions(apps, all_apps):
     For resolving inter-app links it needs the full list of apps, even if they end up in
     separate repos (i.e. archive or per app repos).
     """
+    linkres = metadata.DescriptionResolver(all_apps)
     for app in apps.values():
-        app['Description'] = metadata.description_html(app['Description'], metadata.DescriptionResolver(all_apps))
+        if app['Description']:
+            app['Description'] = metadata.description_html(app['Description'], linkres)
 
 
 def get_apps_with_packages(apps, apks):
     """Returns a deepcopy of that subset apps that actually has any associated packages. Skips disabled apps."""
     appsWithPackages = collections.OrderedDict()
+    packageNames = set(apk['packageName'] for apk in apks)
     for packageName in apps:
         app = apps[packageName]
         if app['Disabled']:
             continue
 
         # only include apps with packages
-        for apk in apks:
-            if apk['packageName'] == packageName:
-                newapp = copy.copy(app)
-                appsWithPackages[packageName] = newapp
-                break
+        if packageName in packageNames:
+            newapp = metadata.App(app)
+            appsWithPackages[packageName] = newapp
     return appsWithPackages
 
 
@@ -89,6 +89,7 @@ setup(name='fdroidserver',
       ],
       extras_require={
           'test': ['pyjks'],
+          'speedups': ['lxml', 'orjson'],
       },
       classifiers=[
           'Development Status :: 4 - Beta',